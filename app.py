@@ -1,15 +1,57 @@
-from flask import Flask, request, jsonify, Response, stream_with_context
+from flask import Flask, request, jsonify, Response, send_file
 from flask_cors import CORS
 import subprocess
-import tempfile
 import os
-import sys
 import re
-import shutil
-from psycopg2 import pool
+import json
+import glob
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any
+from urllib.parse import urlparse
+import psycopg2
+from psycopg2 import errors, extensions, pool
+import redis
+from cachetools import TTLCache
 import jwt
 from jwt import PyJWKClient
 from datetime import datetime, timezone
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError
+
+from config import (
+    DB_URL,
+    JWKS_URL,
+    JWT_ISSUER,
+    JWT_AUDIENCE,
+    REDIS_URL,
+    QUOTA_PER_HOUR,
+    DB_CONN_MAX_AGE,
+    DB_POOL_MAX,
+    DB_CHECKOUT_TIMEOUT,
+    JWKS_KEY_TTL,
+    STREAM_CHUNK_SIZE,
+    MAX_AUDIO_BYTES,
+    MAX_CONCURRENT_ENCODES,
+    ENCODE_QUEUE_TIMEOUT,
+    ERROR_DETAILS_MAX,
+    MAX_DURATION,
+    MAX_SOURCE_BYTES,
+    PIPELINE_TIMEOUT,
+    AUDIO_CACHE_TTL,
+    AUDIO_CACHE_MAX_BYTES,
+    AUDIO_CACHE_MAX_ITEM,
+    TMP_ROOT,
+    JOB_WORKERS,
+    JOB_TTL,
+    JOB_PRUNE_INTERVAL,
+    JOB_FILES_MAX_BYTES,
+)
 
 # --------------------------------------------------
 # APP
@@ -26,41 +68,228 @@ def add_headers(response):
     response.headers["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS"
     return response
 
+@app.errorhandler(pool.PoolError)
+def db_pool_exhausted(e):
+    app.logger.error(f"❌ {e}")
+    return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "5"}
+
 # --------------------------------------------------
-# CONFIG (Fly.io secrets)
+# GLOBALS (lazy init)
 # --------------------------------------------------
-DB_URL = os.environ["SUPABASE_DB_URL"]
-JWKS_URL = os.environ["SUPABASE_JWKS_URL"]
-JWT_ISSUER = os.environ["SUPABASE_JWT_ISSUER"]
-JWT_AUDIENCE = os.environ.get("SUPABASE_JWT_AUDIENCE", "authenticated")
+db_pool: pool.ThreadedConnectionPool | None = None
+jwk_client: PyJWKClient | None = None
+redis_client: redis.Redis | None = None
+
+_conn_born: "weakref.WeakKeyDictionary[extensions.connection, float]" = weakref.WeakKeyDictionary()
+_conn_prepared: "weakref.WeakSet[extensions.connection]" = weakref.WeakSet()
+# getconn() raises PoolError instead of waiting when the pool is exhausted,
+# so checkouts queue on this semaphore first
+_db_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+_KID_CACHE: dict[str, tuple[Any, float]] = {}
+_KID_CACHE_LOCK = threading.Lock()
+
+# (user_id, hour bucket) -> end of that hour, for users already over quota
+_QUOTA_NEG: dict[tuple[str, int], float] = {}
+_QUOTA_NEG_LOCK = threading.Lock()
+
+jwt_decoder = jwt.PyJWT(options={"require": ["exp", "iss", "aud", "sub"]})
+
+# (canonical url, fmt) -> encoded audio bytes, bounded by total size
+_AUDIO_CACHE: TTLCache = TTLCache(maxsize=AUDIO_CACHE_MAX_BYTES, ttl=AUDIO_CACHE_TTL, getsizeof=len)
+_AUDIO_CACHE_LOCK = threading.Lock()
+_encode_slots = threading.BoundedSemaphore(MAX_CONCURRENT_ENCODES)
+
+_TIKTOK_RE = re.compile(r"^(?:www\.|vm\.|vt\.|m\.)?tiktok\.com$")
+
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+_last_prune = 0.0
+_PRUNE_LOCK = threading.Lock()
 
-QUOTA_PER_HOUR = 30
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="audio-job")
 
 # --------------------------------------------------
-# GLOBALS (lazy init)
+# YT-DLP
 # --------------------------------------------------
-db_pool: pool.SimpleConnectionPool | None = None
-jwk_client: PyJWKClient | None = None
+# The request is well-formed but this media can't be served; carries the HTTP status
+class MediaRejected(Exception):
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+# Only resolve the media URL in-process; ffmpeg does the actual download
+_YDL_OPTS = {
+    "format": "ba/b",
+    "quiet": True,
+    "no_warnings": True,
+    "noplaylist": True,
+    # Profile/playlist URLs: list entries without extracting every video
+    "extract_flat": "in_playlist",
+    "cachedir": os.path.join(TMP_ROOT, "yt-dlp"),
+}
+
+def resolve_media(url: str) -> tuple[dict, list[str]]:
+    with YoutubeDL(_YDL_OPTS) as ydl:
+        info = ydl.extract_info(url, download=False)
+        media_url = info.get("url")
+        if info.get("_type") == "playlist" or not media_url:
+            raise MediaRejected("URL does not point to a single video", 400)
+        cookies = ydl.cookiejar.get_cookies_for_url(media_url)
+
+    input_args = []
+    headers = info.get("http_headers") or {}
+    if headers:
+        input_args += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+    if cookies:
+        input_args += ["-cookies", "".join(
+            f"{c.name}={c.value}; path={c.path}; domain={c.domain};\r\n" for c in cookies
+        )]
+    return info, input_args + ["-i", media_url]
+
+# Cheap metadata check before any ffmpeg work; returns why the media is rejected
+def media_limit_error(info: dict) -> str | None:
+    if info.get("is_live") or info.get("live_status") in ("is_live", "is_upcoming"):
+        return "Live streams are not supported"
+    # Missing duration means unknown, not zero: ffmpeg's -t MAX_DURATION caps those
+    duration = info.get("duration")
+    if duration is not None and duration > MAX_DURATION:
+        return f"Video too long ({int(duration)}s > {MAX_DURATION}s)"
+    filesize = info.get("filesize") or info.get("filesize_approx") or 0
+    if filesize > MAX_SOURCE_BYTES:
+        return f"Video too large ({filesize} bytes > {MAX_SOURCE_BYTES} bytes)"
+    return None
+
+# --------------------------------------------------
+# AUDIO FORMATS
+# --------------------------------------------------
+AUDIO_FORMATS = {
+    "mp3": {
+        # One thread per encode: concurrency comes from parallel requests
+        "ffmpeg_args": [
+            "-acodec", "libmp3lame",
+            "-q:a", "5",
+            "-ac", "2",
+            "-ar", "44100",
+            "-threads", "1",
+            "-f", "mp3",
+        ],
+        "mimetype": "audio/mpeg",
+    },
+    # TikTok audio is already AAC: stream-copy it into ADTS, no re-encode
+    "aac": {
+        "ffmpeg_args": ["-c:a", "copy", "-f", "adts"],
+        "mimetype": "audio/aac",
+    },
+}
 
 # --------------------------------------------------
 # DB POOL
 # --------------------------------------------------
+# Stamps every connection when it is opened, including the minconn ones
+# created with the pool, so DB_CONN_MAX_AGE counts from connect()
+class StampedConnectionPool(pool.ThreadedConnectionPool):
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        _conn_born[conn] = time.monotonic()
+        return conn
+
 def init_db_pool():
     global db_pool
     if db_pool is None:
         app.logger.info("🔌 Initializing PostgreSQL connection pool")
-        db_pool = pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=20,  # SAFE: Supabase Free (60) / 2 Fly machines / streaming
+        db_pool = StampedConnectionPool(
+            minconn=2,
+            maxconn=DB_POOL_MAX,
             dsn=DB_URL,
         )
     return db_pool
 
+QUOTA_UPSERT_SQL = """
+    INSERT INTO api_usage (user_id, hour_bucket, count)
+    VALUES (%s, date_trunc('hour', now()), 1)
+    ON CONFLICT (user_id, hour_bucket)
+    DO UPDATE SET count = api_usage.count + 1
+    RETURNING count
+"""
+
+# Prepared once per connection: the parameter type is inferred from api_usage.user_id
+def prepare_statements(conn):
+    try:
+        with conn.cursor() as cur:
+            cur.execute("PREPARE quota_upsert AS " + QUOTA_UPSERT_SQL.replace("%s", "$1"))
+        conn.commit()
+    except errors.DuplicatePreparedStatement:
+        # Behind a transaction-mode pooler the backend may already have it
+        conn.rollback()
+
+def is_conn_alive(conn) -> bool:
+    if conn.closed or conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_conn():
-    return init_db_pool().getconn()
+    db = init_db_pool()
+    if not _db_slots.acquire(timeout=DB_CHECKOUT_TIMEOUT):
+        raise pool.PoolError("Timed out waiting for a PostgreSQL connection")
+    try:
+        # Every idle connection may be stale: allow one full sweep plus a fresh connect
+        for _ in range(db.maxconn + 1):
+            conn = db.getconn()
+            try:
+                age = time.monotonic() - _conn_born.get(conn, 0.0)
+                if age < DB_CONN_MAX_AGE and is_conn_alive(conn):
+                    if conn not in _conn_prepared:
+                        prepare_statements(conn)
+                        _conn_prepared.add(conn)
+                    return conn
+            except Exception:
+                # Never leak a slot of the pool on an unexpected error
+                db.putconn(conn, close=True)
+                raise
+            app.logger.info("♻️ Recycling PostgreSQL connection")
+            db.putconn(conn, close=True)
+        raise psycopg2.OperationalError("No healthy PostgreSQL connection available")
+    except Exception:
+        _db_slots.release()
+        raise
 
 def release_conn(conn):
-    init_db_pool().putconn(conn)
+    try:
+        init_db_pool().putconn(conn)
+    finally:
+        _db_slots.release()
+
+@contextmanager
+def db_cursor():
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            yield cur
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_conn(conn)
+
+# --------------------------------------------------
+# REDIS
+# --------------------------------------------------
+def get_redis():
+    global redis_client
+    if redis_client is None and REDIS_URL:
+        app.logger.info("🧮 Initializing Redis client")
+        redis_client = redis.Redis(
+            connection_pool=redis.ConnectionPool.from_url(REDIS_URL),
+        )
+    return redis_client
 
 # --------------------------------------------------
 # JWKS
@@ -72,6 +301,20 @@ def get_jwk_client():
         jwk_client = PyJWKClient(JWKS_URL)
     return jwk_client
 
+def get_signing_key(token: str):
+    kid = jwt.get_unverified_header(token)["kid"]
+    now = time.monotonic()
+
+    with _KID_CACHE_LOCK:
+        cached = _KID_CACHE.get(kid)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    key = get_jwk_client().get_signing_key(kid).key
+    with _KID_CACHE_LOCK:
+        _KID_CACHE[kid] = (key, now + JWKS_KEY_TTL)
+    return key
+
 # --------------------------------------------------
 # AUTH
 # --------------------------------------------------
@@ -83,11 +326,9 @@ def verify_jwt_and_get_user():
     token = auth.split(" ", 1)[1]
 
     try:
-        signing_key = get_jwk_client().get_signing_key_from_jwt(token)
-
-        payload = jwt.decode(
+        payload = jwt_decoder.decode(
             token,
-            signing_key.key,
+            get_signing_key(token),
             algorithms=["ES256"],
             audience=JWT_AUDIENCE,
             issuer=JWT_ISSUER,
@@ -105,128 +346,509 @@ def verify_jwt_and_get_user():
 # QUOTA
 # --------------------------------------------------
 def increment_usage(user_id: str) -> int:
-    conn = get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO api_usage (user_id, hour_bucket, count)
-                VALUES (%s, date_trunc('hour', now()), 1)
-                ON CONFLICT (user_id, hour_bucket)
-                DO UPDATE SET count = api_usage.count + 1
-                RETURNING count;
-            """, (user_id,))
-            count = cur.fetchone()[0]
-            app.logger.info(f"📈 Usage user={user_id} count={count}")
-            return count
-    finally:
-        release_conn(conn)
+    r = get_redis()
+    count = None
+    if r is not None:
+        key = f"quota:{user_id}:{int(time.time() // 3600)}"
+        try:
+            pipe = r.pipeline()
+            pipe.incr(key)
+            pipe.expire(key, 3700)
+            count, _ = pipe.execute()
+        except redis.RedisError as e:
+            app.logger.error(f"❌ Redis quota counter failed, using Postgres: {e}")
+    if count is None:
+        count = increment_usage_db(user_id)
+
+    app.logger.info(f"📈 Usage user={user_id} count={count}")
+    return count
+
+def is_quota_exhausted(user_id: str) -> bool:
+    now = time.time()
+    with _QUOTA_NEG_LOCK:
+        expires = _QUOTA_NEG.get((user_id, int(now // 3600)))
+    return expires is not None and expires > now
+
+def mark_quota_exhausted(user_id: str):
+    now = time.time()
+    bucket = int(now // 3600)
+    with _QUOTA_NEG_LOCK:
+        for key in [k for k, expires in _QUOTA_NEG.items() if expires <= now]:
+            del _QUOTA_NEG[key]
+        _QUOTA_NEG[(user_id, bucket)] = (bucket + 1) * 3600
+
+def quota_exceeded_response():
+    reset_at = datetime.now(timezone.utc).replace(
+        minute=0, second=0, microsecond=0
+    )
+    return jsonify({
+        "error": "Quota exceeded",
+        "limit": QUOTA_PER_HOUR,
+        "reset_at": reset_at.isoformat(),
+    }), 429
+
+def increment_usage_db(user_id: str) -> int:
+    with db_cursor() as cur:
+        try:
+            cur.execute("EXECUTE quota_upsert(%s)", (user_id,))
+        except errors.InvalidSqlStatementName:
+            # Transaction-mode pooler routed us to a backend without the statement
+            cur.connection.rollback()
+            cur.execute(QUOTA_UPSERT_SQL, (user_id,))
+        return cur.fetchone()[0]
 
 # --------------------------------------------------
 # UTILS
 # --------------------------------------------------
 def is_valid_tiktok_url(url: str) -> bool:
-    return bool(re.search(r"(vm\.tiktok\.com|tiktok\.com)", url))
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return False
+    if parsed.scheme != "https":
+        return False
+    return bool(_TIKTOK_RE.match(parsed.hostname or ""))
+
+def canonical_tiktok_url(url: str) -> str:
+    # Drop query/fragment (share tracking params) so every share hits one entry
+    parsed = urlparse(url)
+    return f"https://{parsed.hostname}{parsed.path.rstrip('/')}"
+
+def pick_audio_format() -> str | None:
+    fmt = request.args.get("fmt")
+    if fmt:
+        return fmt if fmt in AUDIO_FORMATS else None
+    if request.accept_mimetypes.best_match(["audio/mpeg", "audio/aac"]) == "audio/aac":
+        return "aac"
+    return "mp3"
+
+def ffmpeg_command(
+    ffmpeg_input: list[str],
+    audio_format: dict,
+    output: str,
+    max_bytes: int | None = None,
+) -> list[str]:
+    # -fs stops ffmpeg at max_bytes; callers must treat a file that big as truncated
+    size_limit = ["-fs", str(max_bytes)] if max_bytes else []
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "error",
+        *ffmpeg_input,
+        "-vn",
+        *audio_format["ffmpeg_args"],
+        "-t", str(MAX_DURATION),
+        *size_limit,
+        "-y", output,
+    ]
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def stop_processes(*procs: subprocess.Popen):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        for stream in (proc.stdout, proc.stderr):
+            if stream:
+                stream.close()
+
+# Drains stderr alongside stdout so ffmpeg never blocks on a full pipe; keeps the tail
+def start_stderr_drain(proc: subprocess.Popen) -> tuple[threading.Thread, bytearray]:
+    tail = bytearray()
+
+    def drain():
+        while True:
+            chunk = proc.stderr.read1(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            tail.extend(chunk)
+            del tail[:-ERROR_DETAILS_MAX]
+
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+    return thread, tail
+
+def start_watchdog(*procs: subprocess.Popen) -> threading.Timer:
+    def expire():
+        app.logger.error(f"⏱️ Pipeline exceeded {PIPELINE_TIMEOUT}s, terminating")
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+
+    timer = threading.Timer(PIPELINE_TIMEOUT, expire)
+    timer.daemon = True
+    timer.start()
+    return timer
 
 # --------------------------------------------------
-# STREAM MP3
+# REQUEST CHECKS
 # --------------------------------------------------
-@app.route("/tiktok/mp3", methods=["POST", "OPTIONS"])
-def tiktok_mp3():
-    app.logger.info("➡️ /tiktok/mp3 called")
+# Returns ((user_id, url, fmt), None) or (None, error response)
+def check_audio_request(pre_quota=None):
+    # Cheapest checks first: payload shape and URL, then JWT crypto, then the quota write.
+    # pre_quota() may return an error response to reject the request before it is charged.
+    data = request.get_json(silent=True)
+    url = data.get("url") if isinstance(data, dict) else None
+    url = url.strip() if isinstance(url, str) else None
 
-    if request.method == "OPTIONS":
-        return "", 200
+    if not url or not is_valid_tiktok_url(url):
+        return None, (jsonify({"error": "Invalid or missing URL"}), 400)
+
+    fmt = pick_audio_format()
+    if not fmt:
+        return None, (jsonify({"error": "Unsupported format", "formats": list(AUDIO_FORMATS)}), 400)
 
     user_id = verify_jwt_and_get_user()
     if not user_id:
-        return jsonify({"error": "Unauthorized"}), 401
+        return None, (jsonify({"error": "Unauthorized"}), 401)
+
+    if pre_quota:
+        error = pre_quota()
+        if error:
+            return None, error
+
+    # Known over-quota users are rejected without touching Redis/Postgres
+    if is_quota_exhausted(user_id):
+        return None, quota_exceeded_response()
 
     count = increment_usage(user_id)
     if count > QUOTA_PER_HOUR:
-        reset_at = datetime.now(timezone.utc).replace(
-            minute=0, second=0, microsecond=0
-        )
-        return jsonify({
-            "error": "Quota exceeded",
-            "limit": QUOTA_PER_HOUR,
-            "reset_at": reset_at.isoformat(),
-        }), 429
+        mark_quota_exhausted(user_id)
+        return None, quota_exceeded_response()
 
-    data = request.get_json(silent=True)
-    url = data.get("url").strip() if data else None
+    return (user_id, url, fmt), None
 
-    if not url or not is_valid_tiktok_url(url):
-        return jsonify({"error": "Invalid or missing URL"}), 400
+# --------------------------------------------------
+# STREAM AUDIO
+# --------------------------------------------------
+@app.route("/tiktok/mp3", methods=["POST", "OPTIONS"])
+def tiktok_mp3():
+    app.logger.info("➡️ /tiktok/mp3 called")
 
-    temp_dir = tempfile.mkdtemp(prefix="tiktok_mp3_")
-    video_path = os.path.join(temp_dir, "video.mp4")
-    audio_path = os.path.join(temp_dir, "audio.mp3")
+    if request.method == "OPTIONS":
+        return "", 200
 
+    params, error = check_audio_request()
+    if error:
+        return error
+    _, url, fmt = params
+
+    audio_format = AUDIO_FORMATS[fmt]
+    headers = {
+        "Content-Disposition": f"attachment; filename=tiktok_audio.{fmt}",
+        "Cache-Control": "no-store",
+        "Accept-Ranges": "none",
+    }
+
+    cache_key = (canonical_tiktok_url(url), fmt)
+    with _AUDIO_CACHE_LOCK:
+        cached = _AUDIO_CACHE.get(cache_key)
+    if cached is not None:
+        app.logger.info(f"⚡ Audio cache hit {cache_key[0]} ({fmt})")
+        return Response(cached, content_type=audio_format["mimetype"], headers=headers)
+
+    # Each encode buffers up to MAX_AUDIO_BYTES: cap how many run at once per worker
+    if not _encode_slots.acquire(timeout=ENCODE_QUEUE_TIMEOUT):
+        app.logger.error("❌ No free encode slot")
+        return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "30"}
     try:
-        # Download video
-        subprocess.run(
-            [
-                sys.executable, "-m", "yt_dlp",
-                "-f", "bv*+ba/b",
-                "--merge-output-format", "mp4",
-                "--no-part",
-                "--no-playlist",
-                "--quiet",
-                "-o", video_path,
-                url,
-            ],
-            stdout=subprocess.DEVNULL,
+        try:
+            info, ffmpeg_input = resolve_media(url)
+        except MediaRejected as e:
+            app.logger.info(f"🚫 {e}")
+            return jsonify({"error": str(e)}), e.status
+        except DownloadError as e:
+            app.logger.error("❌ Video extraction failed")
+            return jsonify({
+                "error": "Video download failed",
+                "details": str(e),
+            }), 500
+
+        limit_error = media_limit_error(info)
+        if limit_error:
+            app.logger.info(f"🚫 {limit_error}")
+            return jsonify({"error": limit_error}), 413
+
+        ffmpeg = subprocess.Popen(
+            ffmpeg_command(ffmpeg_input, audio_format, "pipe:1"),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            check=True,
         )
+        watchdog = start_watchdog(ffmpeg)
+        stderr_drain, stderr_tail = start_stderr_drain(ffmpeg)
+
+        # TikTok audio is a few MB: buffer it so the client gets a Content-Length
+        chunks = []
+        size = 0
+        try:
+            while True:
+                chunk = ffmpeg.stdout.read1(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_AUDIO_BYTES:
+                    app.logger.error(f"❌ Audio exceeds {MAX_AUDIO_BYTES} bytes")
+                    return jsonify({"error": "Audio too large", "limit": MAX_AUDIO_BYTES}), 413
+                chunks.append(chunk)
+            returncode = ffmpeg.wait()
+        finally:
+            watchdog.cancel()
+            if ffmpeg.poll() is None:
+                ffmpeg.kill()
+            # stderr hits EOF once ffmpeg is gone; join before its pipe is closed
+            stderr_drain.join()
+            stop_processes(ffmpeg)
+
+        if returncode != 0 or not chunks:
+            app.logger.error(f"❌ {fmt.upper()} processing failed")
+            return jsonify({
+                "error": f"Video download or {fmt.upper()} encoding failed",
+                "details": bytes(stderr_tail).decode(errors="ignore"),
+            }), 500
+
+        data = b"".join(chunks)
+    finally:
+        _encode_slots.release()
 
-        # Convert to MP3
-        subprocess.run(
-            [
-                "ffmpeg", "-y",
-                "-i", video_path,
-                "-vn",
-                "-acodec", "libmp3lame",
-                "-ab", "192k",
-                audio_path,
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-            check=True,
-        )
+    if size <= AUDIO_CACHE_MAX_ITEM:
+        with _AUDIO_CACHE_LOCK:
+            _AUDIO_CACHE[cache_key] = data
+
+    # bytes body: Flask sets Content-Length (🔑 progression Flutter)
+    return Response(data, content_type=audio_format["mimetype"], headers=headers)
 
-        mp3_size = os.path.getsize(audio_path)
+# --------------------------------------------------
+# JOBS
+# --------------------------------------------------
+# Job state lives next to the output in TMP_ROOT so every gunicorn worker
+# on the machine can answer for jobs started by another one.
+# {"user_id", "fmt", "status", "path", "error", "http_status",
+#  "owner_pid", "created_at", "started_at", "finished_at"}
+def job_state_path(job_id: str) -> str:
+    return os.path.join(TMP_ROOT, f"tiktok_job_{job_id}.json")
+
+def read_job(job_id: str) -> dict | None:
+    if not _JOB_ID_RE.match(job_id):
+        return None
+    try:
+        with open(job_state_path(job_id)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
 
-        def generate():
+def write_job(job_id: str, job: dict):
+    # Unique temp name: several workers may write the same job concurrently
+    fd, tmp_path = tempfile.mkstemp(dir=TMP_ROOT, prefix="tiktok_job_", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, job_state_path(job_id))
+    except BaseException:
+        remove_file(tmp_path)
+        raise
+
+# Moves a pending job to a final state; False if another worker already did
+def finish_job(job_id: str, **fields) -> bool:
+    job = read_job(job_id)
+    if not job or job.get("status") != "pending":
+        return False
+    job.update(fields, finished_at=time.time())
+    write_job(job_id, job)
+    return True
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def prune_jobs():
+    global _last_prune
+    now = time.time()
+    # Every poll calls this: scan the job files at most once per interval per process
+    with _PRUNE_LOCK:
+        if now - _last_prune < JOB_PRUNE_INTERVAL:
+            return
+        _last_prune = now
+
+    cutoff = now - JOB_TTL
+    for state_path in glob.glob(os.path.join(TMP_ROOT, "tiktok_job_*.json")):
+        job_id = os.path.basename(state_path)[len("tiktok_job_"):-len(".json")]
+        job = read_job(job_id)
+        if not job:
+            continue
+        owner_pid = job.get("owner_pid")
+        if job.get("status") == "pending" and not (owner_pid and is_process_alive(owner_pid)):
+            # Its worker was recycled/killed mid-job: fail it so clients stop polling.
+            # Jobs still queued in a live worker's executor are left alone.
+            if finish_job(job_id, status="failed", error="Job was interrupted"):
+                app.logger.error(f"❌ Job {job_id} never finished, marking failed")
+                remove_file(os.path.join(TMP_ROOT, f"tiktok_job_{job_id}.{job.get('fmt')}"))
+            continue
+        finished_at = job.get("finished_at")
+        if not finished_at or finished_at >= cutoff:
+            continue
+        if job.get("path"):
+            remove_file(job["path"])
+        remove_file(state_path)
+
+def job_files_size() -> int:
+    total = 0
+    for fmt in AUDIO_FORMATS:
+        for path in glob.glob(os.path.join(TMP_ROOT, f"tiktok_job_*.{fmt}")):
             try:
-                with open(audio_path, "rb") as f:
-                    while True:
-                        chunk = f.read(8192)
-                        if not chunk:
-                            break
-                        yield chunk
-            finally:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-
-        return Response(
-            stream_with_context(generate()),
-            content_type="audio/mpeg",
-            headers={
-                "Content-Disposition": "attachment; filename=tiktok_audio.mp3",
-                "Content-Length": str(mp3_size),  # 🔑 progression Flutter
-                "Cache-Control": "no-store",
-                "Accept-Ranges": "none",
-            },
-        )
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+    return total
+
+def check_job_storage():
+    # Job outputs live in RAM (/dev/shm): refuse new work before charging quota
+    prune_jobs()
+    if job_files_size() > JOB_FILES_MAX_BYTES:
+        app.logger.error("❌ Job storage full")
+        return jsonify({"error": "Server busy, try again later"}), 503, {"Retry-After": "60"}
+    return None
+
+def run_audio_job(job_id: str, url: str, fmt: str):
+    audio_format = AUDIO_FORMATS[fmt]
+    path = os.path.join(TMP_ROOT, f"tiktok_job_{job_id}.{fmt}")
+    cache_key = (canonical_tiktok_url(url), fmt)
+
+    # Defensive: the state may have been failed or pruned while queued
+    job = read_job(job_id)
+    if not job or job.get("status") != "pending":
+        return
+    job["started_at"] = time.time()
+    write_job(job_id, job)
+
+    try:
+        with _AUDIO_CACHE_LOCK:
+            cached = _AUDIO_CACHE.get(cache_key)
+        if cached is not None:
+            with open(path, "wb") as f:
+                f.write(cached)
+        else:
+            info, ffmpeg_input = resolve_media(url)
+            limit_error = media_limit_error(info)
+            if limit_error:
+                raise MediaRejected(limit_error, 413)
+            subprocess.run(
+                ffmpeg_command(ffmpeg_input, audio_format, path, max_bytes=MAX_AUDIO_BYTES),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=True,
+                timeout=PIPELINE_TIMEOUT,
+            )
+            size = os.path.getsize(path)
+            if size >= MAX_AUDIO_BYTES:
+                raise MediaRejected(f"Audio too large (limit {MAX_AUDIO_BYTES} bytes)", 413)
+            if size <= AUDIO_CACHE_MAX_ITEM:
+                with open(path, "rb") as f:
+                    data = f.read()
+                with _AUDIO_CACHE_LOCK:
+                    _AUDIO_CACHE[cache_key] = data
+
+        if finish_job(job_id, status="done", path=path):
+            app.logger.info(f"✅ Job {job_id} done")
+        else:
+            # Already failed by prune_jobs() in some worker: nobody will serve this file
+            remove_file(path)
+
+    except MediaRejected as e:
+        app.logger.info(f"🚫 Job {job_id} rejected: {e}")
+        remove_file(path)
+        finish_job(job_id, status="failed", error=str(e), http_status=e.status)
 
-    except subprocess.CalledProcessError as e:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        app.logger.error("❌ MP3 processing failed")
+    except Exception as e:
+        if isinstance(e, subprocess.CalledProcessError):
+            details = e.stderr[-ERROR_DETAILS_MAX:].decode(errors="ignore")
+        else:
+            details = str(e)[-ERROR_DETAILS_MAX:]
+        app.logger.error(f"❌ Job {job_id} failed: {details}")
+        remove_file(path)
+        finish_job(job_id, status="failed", error=details)
+
+@app.route("/jobs", methods=["POST", "OPTIONS"])
+def create_job():
+    app.logger.info("➡️ /jobs called")
+
+    if request.method == "OPTIONS":
+        return "", 200
+
+    params, error = check_audio_request(pre_quota=check_job_storage)
+    if error:
+        return error
+    user_id, url, fmt = params
+
+    job_id = uuid.uuid4().hex
+    write_job(job_id, {
+        "user_id": user_id,
+        "fmt": fmt,
+        "status": "pending",
+        "path": None,
+        "error": None,
+        "owner_pid": os.getpid(),
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+    })
+    job_executor.submit(run_audio_job, job_id, url, fmt)
+
+    return jsonify({"job_id": job_id, "url": f"/jobs/{job_id}/stream"}), 202
+
+# GET also answers HEAD, so clients can probe status/size/ranges before downloading
+@app.route("/jobs/<job_id>/stream", methods=["GET", "OPTIONS"])
+def stream_job(job_id: str):
+    if request.method == "OPTIONS":
+        return "", 200
+
+    user_id = verify_jwt_and_get_user()
+    if not user_id:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    # Clients poll this endpoint: expire old outputs even when no new jobs arrive
+    prune_jobs()
+    job = read_job(job_id)
+    if not job or job.get("user_id") != user_id or job.get("fmt") not in AUDIO_FORMATS:
+        return jsonify({"error": "Job not found"}), 404
+
+    if job["status"] == "pending":
+        return jsonify({"job_id": job_id, "status": "pending"}), 202
+    if job["status"] == "failed" and job.get("http_status"):
+        return jsonify({"error": job["error"]}), job["http_status"]
+    if job["status"] == "failed":
         return jsonify({
-            "error": "Video download or MP3 encoding failed",
-            "details": e.stderr.decode(errors="ignore"),
+            "error": f"Video download or {job['fmt'].upper()} encoding failed",
+            "details": job["error"],
         }), 500
 
+    # conditional=True: Range/If-* handling, including 416 for bad ranges
+    try:
+        resp = send_file(
+            job["path"],
+            mimetype=AUDIO_FORMATS[job["fmt"]]["mimetype"],
+            as_attachment=True,
+            download_name=f"tiktok_audio.{job['fmt']}",
+            conditional=True,
+            max_age=0,
+        )
+    except (FileNotFoundError, TypeError):
+        # Pruned by another worker between read_job() and here
+        return jsonify({"error": "Job not found"}), 404
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
 # --------------------------------------------------
 # HEALTH
 # --------------------------------------------------
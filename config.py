@@ -0,0 +1,46 @@
+import os
+import tempfile
+
+# --------------------------------------------------
+# CONFIG (Fly.io secrets)
+# --------------------------------------------------
+# Direct or session-mode URL preferred: the quota upsert is a server-side prepared
+# statement. The transaction-mode pooler (port 6543) works, but every request then
+# falls back to the plain upsert.
+DB_URL = os.environ["SUPABASE_DB_URL"]
+JWKS_URL = os.environ["SUPABASE_JWKS_URL"]
+JWT_ISSUER = os.environ["SUPABASE_JWT_ISSUER"]
+JWT_AUDIENCE = os.environ.get("SUPABASE_JWT_AUDIENCE", "authenticated")
+REDIS_URL = os.environ.get("REDIS_URL")  # optional: quota counter falls back to Postgres
+
+QUOTA_PER_HOUR = 30
+DB_CONN_MAX_AGE = 1800  # seconds before a pooled connection is recycled
+DB_POOL_MAX = 8  # SAFE: Supabase Free (60) / 2 Fly machines x gunicorn workers, with headroom
+DB_CHECKOUT_TIMEOUT = 10  # seconds a request waits for a free connection before a 503
+JWKS_KEY_TTL = 3600  # seconds a resolved signing key is trusted per kid
+STREAM_CHUNK_SIZE = 256 * 1024  # max bytes read per call from ffmpeg stdout
+# Memory budget (fly.toml: 1 GiB per machine, 2 gunicorn workers). MAX_DURATION
+# keeps real outputs around 10 MiB; these caps bound the worst case:
+#   2 x (AUDIO_CACHE_MAX_BYTES + MAX_CONCURRENT_ENCODES x MAX_AUDIO_BYTES)
+#   + JOB_FILES_MAX_BYTES in /dev/shm = 2 x (24 + 4 x 25) + 128 = 376 MiB
+MAX_AUDIO_BYTES = 25 * 1024 * 1024  # larger outputs are rejected with 413
+MAX_CONCURRENT_ENCODES = 4  # /tiktok/mp3 encodes buffered at once, per worker
+ENCODE_QUEUE_TIMEOUT = 30  # seconds a request waits for an encode slot before a 503
+ERROR_DETAILS_MAX = 4096  # bytes of ffmpeg stderr returned in error bodies
+MAX_DURATION = 600  # seconds; longer videos are rejected before ffmpeg starts
+MAX_SOURCE_BYTES = 200 * 1024 * 1024  # same, for the reported source file size
+PIPELINE_TIMEOUT = 300  # seconds before ffmpeg is terminated
+AUDIO_CACHE_TTL = 900  # seconds an encoded file is served from memory
+AUDIO_CACHE_MAX_BYTES = 24 * 1024 * 1024  # total size of cached audio, per worker
+AUDIO_CACHE_MAX_ITEM = 8 * 1024 * 1024  # larger files are returned but not cached
+JOB_WORKERS = 2  # background yt-dlp/ffmpeg jobs run at once per process
+JOB_TTL = 900  # seconds a finished job's file is kept for download
+JOB_FILES_MAX_BYTES = 128 * 1024 * 1024  # new jobs get 503 while outputs exceed this
+JOB_PRUNE_INTERVAL = 30  # seconds between job directory scans, per process
+
+# RAM-backed scratch space when the VM has it, regular temp dir otherwise
+TMP_ROOT = (
+    "/dev/shm"
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK)
+    else tempfile.gettempdir()
+)
@@ -0,0 +1,31 @@
+import subprocess
+
+# gevent's default is 1000 connections per worker; keep idle/slow clients from
+# piling up behind the encode slots (config.MAX_CONCURRENT_ENCODES)
+worker_connections = 100
+
+# --------------------------------------------------
+# GEVENT + PSYCOPG2
+# --------------------------------------------------
+# libpq does its I/O in C, out of reach of gevent's monkey-patching: without
+# this wait callback every Postgres round trip blocks the whole worker.
+def post_fork(server, worker):
+    from psycogreen.gevent import patch_psycopg
+
+    patch_psycopg()
+
+# --------------------------------------------------
+# WORKER WARM-UP
+# --------------------------------------------------
+# post_worker_init rather than post_fork: the gevent worker monkey-patches
+# the stdlib in init_process, and yt-dlp pulls in ssl/socket on import.
+def post_worker_init(worker):
+    from yt_dlp import YoutubeDL
+
+    YoutubeDL({"quiet": True}).close()
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-version"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    worker.log.info("🔥 yt-dlp and ffmpeg warmed up")